@@ -1,30 +1,168 @@
-import configparser
+import functools
 import git
+import json
 import logging
+import os
 import re
+import tempfile
 
 from dataclasses import dataclass, field
 from functools import cached_property
 
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
 LOG = logging.getLogger(__name__)
 
+HEXSHA_RE = re.compile(r'[0-9a-f]{40}')
+
+# the summary line that "git log --shortstat" prints for each commit; the
+# insertions and deletions are left out when they are zero.
+SHORTSTAT_RE = re.compile(
+    rb'(\d+) files? changed'
+    rb'(?:, (\d+) insertions?\(\+\))?'
+    rb'(?:, (\d+) deletions?\(-\))?')
+
+# the subset of git configuration syntax understood by _fast_git_config
+CONFIG_SECTION_RE = re.compile(
+    r'^\[(?P<section>[^\s"\]]+)(?:\s+"(?P<subsection>[^"\\]*)")?\]$')
+CONFIG_KV_RE = re.compile(
+    r'^(?P<key>[A-Za-z][\w-]*)\s*=\s*(?P<value>[^"\\;#]*)$')
+
 
 @dataclass
 class Branch:
     name: str
-    head: str = field(init=False)
-    commits: list = field(repr=False)
+    head: git.Commit
+    length: int = field(repr=False)
 
     shortid_len = 10
 
-    def __post_init__(self):
-        self.head = self.commits[0]
+    @cached_property
+    def commits(self):
+        # most commands only need the branch head, so we only read the
+        # list of commits when someone asks for it.
+        return list(self.head.repo.iter_commits(
+            self.head, first_parent=True, max_count=self.length))
 
     @property
     def hexsha(self):
         return self.head.hexsha
 
 
+def _config_files(repo):
+    # the same files (in the same order) that repo.config_reader() reads,
+    # along with their modification times so that _read_fast_config can
+    # tell when its cached results are stale.
+    xdg_config_home = os.environ.get('XDG_CONFIG_HOME',
+                                     os.path.expanduser('~/.config'))
+    paths = [
+        '/etc/gitconfig',
+        os.path.join(xdg_config_home, 'git', 'config'),
+        os.path.expanduser('~/.gitconfig'),
+        os.path.join(repo.common_dir, 'config'),
+    ]
+
+    files = []
+    for path in paths:
+        try:
+            files.append((path, os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            pass
+
+    return tuple(files)
+
+
+def _fast_git_config(path):
+    # a minimal parser for the simple "[section "subsection"]" and
+    # "key = value" lines that make up most git configuration files. It
+    # raises ValueError for anything else (quoted values, includes,
+    # continuation lines, etc) so that the caller can fall back to
+    # GitConfigParser.
+    sections = {}
+    section = None
+
+    with open(path, encoding='utf-8') as fd:
+        for line in fd:
+            stripped = line.strip()
+            if not stripped or stripped[0] in '#;':
+                continue
+
+            if match := CONFIG_SECTION_RE.match(stripped):
+                name = match.group('section').lower()
+                if name in ['include', 'includeif']:
+                    raise ValueError(f'{path}: includes are not supported')
+
+                section = sections.setdefault(
+                    (name, match.group('subsection')), {})
+            elif section is not None and (match := CONFIG_KV_RE.match(stripped)):
+                section[match.group('key').lower()] = match.group('value')
+            else:
+                raise ValueError(f'{path}: unable to parse: {stripped}')
+
+    return sections
+
+
+def _split_section(section):
+    # GitConfigParser returns section names as they appear in the file
+    # (e.g. 'branch "main"'), including any escapes in the subsection.
+    name, _, subsection = section.partition(' ')
+    subsection = subsection.strip()
+    if len(subsection) >= 2 and subsection[0] == subsection[-1] == '"':
+        subsection = re.sub(r'\\(.)', r'\1', subsection[1:-1])
+
+    return name.lower(), subsection or None
+
+
+def _slow_git_config(repo):
+    # GitConfigParser only follows includeIf sections when it knows which
+    # repository it is reading the configuration for.
+    reader = repo.config_reader()
+
+    sections = {}
+    for section in reader.sections():
+        # a key without a value (e.g. "[ptt] commitGraph") means true
+        sections.setdefault(_split_section(section), {}).update(
+            (k.lower(), 'true' if v is None else v)
+            for k, v in reader.items(section))
+
+    return sections
+
+
+@functools.lru_cache(maxsize=8)
+def _read_fast_config(files):
+    # _fast_git_config refuses files with includes, so the paths and
+    # mtimes in files cover everything that went into the result.
+    sections = {}
+    for path, mtime in files:
+        for key, values in _fast_git_config(path).items():
+            sections.setdefault(key, {}).update(values)
+
+    return sections
+
+
+def _read_config(repo):
+    # returns a {(section, subsection): {key: value}} dictionary. Section
+    # and key names are lowercased, because git treats them as case
+    # insensitive.
+    try:
+        return _read_fast_config(_config_files(repo))
+    except (OSError, ValueError) as err:
+        # GitConfigParser skips files it can't read
+        LOG.debug('using GitConfigParser: %s', err)
+        return _slow_git_config(repo)
+
+
+@functools.lru_cache(maxsize=8)
+def _marker_pattern(marker):
+    # shared by all PTT instances using the same marker
+    return re.compile(
+        r'^\s*{}(?P<branch>\S+)$'.format(re.escape(marker)),
+        re.IGNORECASE | re.MULTILINE)
+
+
 class ApplicationError(Exception):
     pass
 
@@ -47,22 +185,38 @@ class PTT:
     default_short_id_len = 10
 
     def __init__(self, repo, base=None, remote=None, marker=None,
-                 short_id_len=None):
+                 short_id_len=None, write_commit_graph=None):
         self.repo = repo
+        config = self.config
+
         self.base = repo.commit(
             base or
-            self.config.get('base', self.default_base)
+            config.get('base', self.default_base)
         )
         self.marker = (
             marker
-            or self.config.get('marker', self.default_marker)
+            or config.get('marker', self.default_marker)
+        )
+        self._marker_re = _marker_pattern(self.marker)
+        self._marker_lower = self.marker.lower()
+        self._marker_cased = self._marker_lower != self.marker.upper()
+        self._marker_plain = (
+            not self._marker_cased
+            and self.marker.split() == [self.marker]
         )
         self.short_id_len = (
             short_id_len or
-            self.config.get('short_id_len', self.default_short_id_len)
+            config.get('short_id_len', self.default_short_id_len)
         )
 
-        self._remote = remote or self.config.get('remote')
+        self._remote = remote or config.get('remote')
+        self._branch_cache = {}
+
+        if write_commit_graph is None:
+            write_commit_graph = self.config_bool('commitgraph')
+        if write_commit_graph and not self.has_commit_graph():
+            self.write_commit_graph()
+
         self.update_branches()
 
     @cached_property
@@ -77,49 +231,215 @@ class PTT:
 
         return _remote
 
+    @cached_property
+    def config_sections(self):
+        return _read_config(self.repo)
+
     @cached_property
     def config(self):
-        reader = self.repo.config_reader()
+        sections = self.config_sections
         _config = {}
-
-        # the confgi reader apparently needs to be "primed" before it
-        # will return accurate information.
-        reader.sections()
+        _config.update(sections.get(('ptt', None), {}))
 
         try:
-            _config.update(dict(reader.items('ptt')))
-        except configparser.NoSectionError:
-            pass
-
-        try:
-            _config.update(dict(reader.items(f'ptt "{self.repo.head.ref.name}"')))
-        except (TypeError, configparser.NoSectionError):
+            _config.update(sections.get(('ptt', self.repo.head.ref.name), {}))
+        except TypeError:
             # trying to access a branch config when in a detached state
             # raises a TypeError
             pass
 
         return _config
 
-    def update_branches(self):
-        commits = self.repo.head.commit.traverse(
-            prune=lambda i, d: i == self.base,
+    def config_bool(self, k, default=False):
+        val = self.config.get(k)
+        if val is None:
+            return default
+
+        return val.lower() in ['true', 'yes', 'on', '1']
+
+    @cached_property
+    def notes_ref(self):
+        # the ref that "git notes" reads by default
+        return os.environ.get(
+            'GIT_NOTES_REF',
+            self.config_sections.get(('core', None), {}).get('notesref', 'refs/notes/commits'),
+        )
+
+    @cached_property
+    def notes_hexsha(self):
+        # the commit the notes ref points at, or None if there are no notes.
+        # core.notesRef and GIT_NOTES_REF don't have to be under refs/, so
+        # skip GitPython's path check.
+        ref = git.Reference(self.repo, self.notes_ref, check_path=False)
+        return ref.commit.hexsha if ref.is_valid() else None
+
+    @cached_property
+    def has_notes(self):
+        return self.notes_hexsha is not None
+
+    @cached_property
+    def notes(self):
+        # map commit ids to note blob ids with a single call to "git notes"
+        # rather than running "git notes show" for every commit.
+        _notes = {}
+        if not self.has_notes:
+            return _notes
+
+        for line in self.repo.git.notes('list').splitlines():
+            note_id, commit_id = line.split()
+            _notes[commit_id] = note_id
+
+        return _notes
+
+    def note_from_commit(self, hexsha):
+        note_id = self.notes.get(hexsha)
+        if note_id is None:
+            return ''
+
+        return self.repo.odb.stream(bytes.fromhex(note_id)).read().decode(
+            'utf-8', errors='replace')
+
+    @cached_property
+    def pg_repo(self):
+        if pygit2 is None:
+            return None
+
+        # libgit2 refuses some repositories that git itself handles (for
+        # example, ones using extensions it doesn't support), in which case
+        # we fall back to "git log".
+        try:
+            return pygit2.Repository(self.repo.working_dir)
+        except pygit2.GitError as err:
+            LOG.debug('not using pygit2: %s', err)
+            return None
+
+    def iter_stack(self):
+        if self.pg_repo is not None:
+            yield from self.iter_stack_pygit2()
+            return
+
+        # read the id, note and message of every commit between base and
+        # HEAD from a single "git log", rather than having GitPython read
+        # each commit object and note.
+        out = self.repo.git.log(
+            f'{self.base.hexsha}..HEAD',
+            '--first-parent',
+            # only read the notes ref that has_notes and the branch cache
+            # look at, not the ones listed in notes.displayRef
+            f'--notes={self.notes_ref}' if self.has_notes else '--no-notes',
+            '--format=%x1e%H%x1f%N%x1f%B',
+            stdout_as_string=False,
         )
 
-        bundle = []
+        for record in out.split(b'\x1e')[1:]:
+            hexsha, note, message = record.split(b'\x1f', 2)
+            yield (hexsha.decode(),
+                   message.decode('utf-8', errors='replace'),
+                   note.decode('utf-8', errors='replace'))
+
+    def iter_stack_pygit2(self):
+        # the same walk as iter_stack, but performed in-process by libgit2.
+        # Notes are left for find_marker to look up if it needs them.
+        walker = self.pg_repo.walk(self.pg_repo.head.target,
+                                   pygit2.GIT_SORT_TOPOLOGICAL)
+        walker.simplify_first_parent()
+        walker.hide(self.base.hexsha)
+
+        for commit in walker:
+            yield (str(commit.id),
+                   commit.raw_message.decode('utf-8', errors='replace'),
+                   None)
+
+    @cached_property
+    def stack_subjects(self):
+        # (commit id, subject) for every commit between base and HEAD
+        return [(hexsha, (message.splitlines() or [''])[0])
+                for hexsha, message, note in self.iter_stack()]
+
+    def branch_subjects(self, branch):
+        # a branch is a contiguous run of the stack starting at its head
+        for i, (hexsha, subject) in enumerate(self.stack_subjects):
+            if hexsha == branch.hexsha:
+                return self.stack_subjects[i:i + branch.length]
+
+        return []
+
+    @property
+    def cache_path(self):
+        return os.path.join(self.repo.git_dir, 'ptt-cache')
+
+    def cache_key(self):
+        # the branch map only depends on these values, so as long as none
+        # of them change we can reuse the result of the last walk.
+        return [
+            self.repo.head.commit.hexsha,
+            self.base.hexsha,
+            self.marker,
+            self.notes_hexsha,
+        ]
+
+    def read_cache(self, key):
+        try:
+            with open(self.cache_path) as fd:
+                cache = json.load(fd)
+
+            if cache['key'] != key:
+                return None
+
+            return {
+                name: Branch(name=name,
+                             head=git.Commit(self.repo, bytes.fromhex(head)),
+                             length=length)
+                for name, head, length in cache['branches']
+            }
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            LOG.debug('not using branch cache: %s', err)
+            return None
+
+    def write_cache(self, key, branches):
+        cache = {
+            'key': key,
+            'branches': [[branch.name, branch.hexsha, branch.length]
+                         for branch in branches.values()],
+        }
+
+        try:
+            with open(f'{self.cache_path}.tmp', 'w') as fd:
+                json.dump(cache, fd)
+            os.replace(f'{self.cache_path}.tmp', self.cache_path)
+        except OSError as err:
+            LOG.warning('failed to write branch cache: %s', err)
+
+    def update_branches(self):
+        key = self.cache_key()
+        if (branches := self.read_cache(key)) is not None:
+            LOG.info('using cached branches for %s', self.format_id(key[0]))
+            self.branches = branches
+            return
+
+        head = None
+        length = 0
         branches = {}
+        debug = LOG.isEnabledFor(logging.DEBUG)
 
-        for rev in commits:
-            LOG.debug('inspecting commit %s', rev)
+        for hexsha, message, note in self.iter_stack():
+            if debug:
+                LOG.debug('inspecting commit %s', hexsha)
 
-            bundle.append(rev)
-            if branch := self.branch_from_commit(rev):
-                LOG.info('found branch %s with %d commits', branch, len(bundle))
-                branch = Branch(name=branch, commits=bundle)
-                branches[branch.name] = branch
-                bundle = []
+            if head is None:
+                head = hexsha
+            length += 1
 
-            rev = rev.parents[0]
+            if branch := self.branch_from_message(hexsha, message, note):
+                LOG.info('found branch %s with %d commits', branch, length)
+                branch = Branch(name=branch,
+                                head=git.Commit(self.repo, bytes.fromhex(head)),
+                                length=length)
+                branches[branch.name] = branch
+                head = None
+                length = 0
 
+        self.write_cache(key, branches)
         self.branches = branches
 
     def __contains__(self, k):
@@ -129,50 +449,148 @@ class PTT:
         return iter(self.branches.values())
 
     def format_id(self, val):
-        commit = self.repo.commit(val)
-        return commit.hexsha[:self.short_id_len]
+        # avoid a lookup when we already have a commit or a full commit id
+        if isinstance(val, git.Object):
+            hexsha = val.hexsha
+        elif isinstance(val, str) and HEXSHA_RE.fullmatch(val):
+            hexsha = val
+        else:
+            hexsha = self.repo.commit(val).hexsha
+
+        return hexsha[:self.short_id_len]
+
+    def branch_stats(self, branch):
+        # this only runs "git log" (rather than reading commit objects through
+        # GitPython's shared cat-file process), so it is safe to call from
+        # multiple threads at once.
+        shortstat = self.repo.git.log(
+            branch.hexsha,
+            '--first-parent',
+            '--diff-merges=first-parent',
+            '--no-renames',
+            '--shortstat',
+            '--format=',
+            max_count=branch.length,
+            stdout_as_string=False,
+            # the summary line is translated in other locales
+            env={'LC_ALL': 'C'},
+        )
+
+        t_added = t_deleted = t_files = 0
+        for files, added, deleted in SHORTSTAT_RE.findall(shortstat):
+            t_files += int(files)
+            t_added += int(added or 0)
+            t_deleted += int(deleted or 0)
+
+        return t_added, t_deleted, t_files
+
+    def has_commit_graph(self):
+        info = os.path.join(self.repo.common_dir, 'objects', 'info')
+        return (
+            os.path.exists(os.path.join(info, 'commit-graph'))
+            or os.path.exists(os.path.join(info, 'commit-graphs',
+                                           'commit-graph-chain'))
+        )
+
+    def write_commit_graph(self):
+        # git reads parent information from the commit-graph file (if one
+        # exists) instead of parsing each commit object, which makes
+        # walking the stack much cheaper in large repositories. This
+        # covers every reachable commit, so it is only worth doing when
+        # the repository doesn't have a commit-graph yet.
+        LOG.info('writing commit-graph')
+        self.repo.git.commit_graph('write', '--reachable', '--changed-paths')
 
     def update_refs(self):
         LOG.info('updating ptt refs')
 
+        existing = {}
+        for line in self.repo.git.for_each_ref(
+                '--format=%(refname) %(objectname)', 'refs/ptt/').splitlines():
+            path, hexsha = line.split()
+            existing[path] = hexsha
+
+        commands = []
+
         # create/update refs
         for branch in self:
-            ref = git.Reference.from_path(self.repo, f'refs/ptt/{branch.name}')
+            path = f'refs/ptt/{branch.name}'
+            hexsha = existing.pop(path, None)
 
-            if ref.is_valid() and ref.commit == branch.head:
+            if hexsha == branch.hexsha:
                 LOG.debug('not updating %s (%s == %s)',
-                          ref.path, self.format_id(ref.commit), self.format_id(branch.head))
+                          path, self.format_id(hexsha), self.format_id(branch.head))
+                continue
+
+            if hexsha is not None:
+                LOG.debug('update ref %s (%s -> %s)',
+                          path, self.format_id(hexsha), self.format_id(branch.head))
             else:
-                if ref.is_valid():
-                    LOG.debug('update ref %s (%s -> %s)',
-                              ref.path, self.format_id(ref.commit), self.format_id(branch.head))
-                else:
-                    LOG.debug('create ref %s (%s)',
-                              ref.path, branch.head)
+                LOG.debug('create ref %s (%s)',
+                          path, branch.head)
 
-                ref.set_commit(branch.head)
+            commands.append(f'update {path} {branch.hexsha}')
 
         # purge obsolete refs
-        for ref in self.repo.refs:
-            if ref.path.startswith('refs/ptt/'):
-                if ref.name not in self:
-                    LOG.debug('delete ref %s', ref.path)
-                    ref.delete(self.repo, ref.path)
+        for path in existing:
+            LOG.debug('delete ref %s', path)
+            commands.append(f'delete {path}')
+
+        # apply all changes in a single transaction
+        if commands:
+            with tempfile.TemporaryFile() as script:
+                script.write(''.join(f'{cmd}\n' for cmd in commands).encode())
+                script.seek(0)
+                self.repo.git.update_ref('--stdin', istream=script)
 
     def branch_from_commit(self, rev):
-        rev = self.repo.commit(rev)
-        pattern = re.compile(r'^\s*{}(?P<branch>\S+)$'.format(self.marker),
-                             re.IGNORECASE | re.MULTILINE)
-        rev_message = rev.message
-        try:
-            rev_note = self.repo.git.notes('show', rev)
-        except git.exc.GitCommandError:
-            rev_note = ''
+        if not isinstance(rev, git.Commit):
+            rev = self.repo.commit(rev)
+
+        return self.branch_from_message(rev.hexsha, rev.message)
+
+    def branch_from_message(self, hexsha, message, note=None):
+        # commits are immutable, so we only need to look at each one once
+        if hexsha not in self._branch_cache:
+            self._branch_cache[hexsha] = self.find_marker(hexsha, message, note)
+
+        return self._branch_cache[hexsha]
 
-        for content in [rev_message, rev_note]:
-            if match := pattern.search(content):
+    def find_marker(self, hexsha, message, note=None):
+        # only look at the note if the commit message doesn't have a marker
+        if branch := self.match_marker(message):
+            return branch
+
+        if note is None:
+            note = self.note_from_commit(hexsha)
+
+        return self.match_marker(note)
+
+    def match_marker(self, content):
+        # most commits have no marker at all, and a substring test rules
+        # those out much more cheaply than the regex.
+        if self._marker_cased:
+            if self._marker_lower not in content.lower():
+                return None
+        elif self.marker not in content:
+            return None
+
+        if not self._marker_plain:
+            if match := self._marker_re.search(content):
                 return match.group('branch')
 
+            return None
+
+        # for markers with no cased characters or whitespace (like the
+        # default "@"), this finds the same match as _marker_re without
+        # going through the regex engine.
+        for line in content.split('\n'):
+            line = line.lstrip()
+            if line.startswith(self.marker):
+                branch = line[len(self.marker):]
+                if branch.split() == [branch]:
+                    return branch
+
     def set_branch_config(self, branch, k, v):
         LOG.debug('set config %s.%s = %s', branch, k, v)
         with self.repo.config_writer() as writer:
@@ -1,14 +1,13 @@
 #!/usr/bin/python3
 
 import click
-import code
+import concurrent.futures
 import functools
 import git
+import io
 import logging
-import readline
-import rlcompleter
+import os
 import sys
-import tabulate
 
 from git_ptt.api import PTT
 
@@ -31,13 +30,97 @@ def handle_git_error(func):
     return wrapper
 
 
+def _print_table(rows, headers):
+    # a minimal version of tabulate's "simple" format: numeric columns are
+    # right aligned, everything else is left aligned.
+    numeric = [
+        bool(rows) and all(
+            isinstance(row[i], int) and not isinstance(row[i], bool)
+            for row in rows)
+        for i in range(len(headers))
+    ]
+    cells = [[str(val) for val in row] for row in rows]
+    widths = [
+        max([len(header) + 2] + [len(row[i]) for row in cells])
+        for i, header in enumerate(headers)
+    ]
+
+    def format_row(vals):
+        return '  '.join(
+            val.rjust(width) if align_right else val.ljust(width)
+            for val, width, align_right in zip(vals, widths, numeric)
+        ).rstrip()
+
+    print(format_row(headers))
+    print(format_row(['-' * width for width in widths]))
+    for row in cells:
+        print(format_row(row))
+
+
+def _push_one(ptt, branch):
+    LOG.warning('pushing commit %s -> %s:%s', ptt.format_id(branch.hexsha), ptt.remote, branch.name)
+    return ptt.remote.push(f'+{branch.hexsha}:refs/heads/{branch.name}')
+
+
+def _delete_one(ptt, branch):
+    LOG.warning('deleting branch %s:%s', ptt.remote, branch.name)
+    return ptt.remote.push(f':refs/heads/{branch.name}', force_with_lease=True)
+
+
+def _map_branches(func, ptt, branches, jobs=None):
+    # every push runs a separate git process, so we can have several of
+    # them in flight at once. Results are returned in the same order as
+    # branches; failures are logged as they happen and reported together
+    # once every branch has been attempted.
+    if not branches:
+        return []
+
+    # resolve the remote before starting any threads
+    ptt.remote
+
+    if jobs is None:
+        jobs = min(16, len(branches))
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(func, ptt, branch): branch
+                   for branch in branches}
+
+        for future in concurrent.futures.as_completed(futures):
+            branch = futures[future]
+            try:
+                res = future.result()
+            except git.exc.GitCommandError as err:
+                LOG.error('failed to update %s:%s: %s',
+                          ptt.remote, branch.name, err)
+                continue
+
+            # GitPython doesn't raise an exception when git reports a
+            # rejected ref (e.g. a stale --force-with-lease), so we need
+            # to check the status of each ref as well.
+            errors = [info for info in res if info.flags & git.PushInfo.ERROR]
+            for info in errors:
+                LOG.error('failed to update %s:%s: %s',
+                          ptt.remote, branch.name, info.summary.strip())
+
+            if not errors:
+                results[branch.name] = res
+
+    failed = [branch.name for branch in branches if branch.name not in results]
+    if failed:
+        raise click.ClickException(f'failed to update {", ".join(failed)}')
+
+    return [results[branch.name] for branch in branches]
+
+
 @click.group(context_settings={'auto_envvar_prefix': 'GIT_PTT'})
 @click.option('-v', '--verbose', count=True)
 @click.option('-r', '--repo')
 @click.option('-b', '--base')
 @click.option('-R', '--remote')
+@click.option('--write-commit-graph/--no-write-commit-graph', default=None)
 @click.pass_context
-def main(ctx, verbose, repo, base, remote):
+def main(ctx, verbose, repo, base, remote, write_commit_graph):
     '''git-ptt is a tool for maintaining stacked pull requests'''
 
     try:
@@ -50,7 +133,9 @@ def main(ctx, verbose, repo, base, remote):
     )
 
     repo = git.Repo(repo)
-    ptt = PTT(repo, base=base, remote=remote)
+    ptt = PTT(repo, base=base, remote=remote,
+              write_commit_graph=write_commit_graph)
+
     ptt.update_refs()
     ctx.obj = ptt
 
@@ -61,13 +146,19 @@ def main(ctx, verbose, repo, base, remote):
 @click.pass_obj
 def ls(ptt, show_commits, selected):
     '''list branch mappings in the local repository'''
+    selected = frozenset(selected)
+
+    # build the listing and write it out in one go
+    buf = io.StringIO()
     for branch in ptt:
         if selected and branch.name not in selected:
             continue
-        print(f'{branch.name} {ptt.format_id(branch.hexsha)}')
+        buf.write(f'{branch.name} {ptt.format_id(branch.hexsha)}\n')
         if show_commits:
-            for commit in branch.commits:
-                print(f'- {ptt.format_id(commit.hexsha)}: {commit.message.splitlines()[0]}')
+            for hexsha, subject in ptt.branch_subjects(branch):
+                buf.write(f'- {ptt.format_id(hexsha)}: {subject}\n')
+
+    sys.stdout.write(buf.getvalue())
 
 
 @main.command()
@@ -77,25 +168,27 @@ def head(ptt, name):
     '''show head of mapped branch'''
     try:
         branch = ptt.branches[name]
-        print(branch.head)
     except KeyError:
-        raise click.ClickException(f'no such branch named {branch}')
+        raise click.ClickException(f'no such branch named {name}')
+
+    print(branch.hexsha)
 
 
 @main.command()
 @click.option('--all/--no-all', '-a', 'all_')
+@click.option('--jobs', '-j', type=click.IntRange(min=1))
 @click.argument('selected', nargs=-1)
 @click.pass_obj
-def push(ptt, all_, selected):
+def push(ptt, all_, jobs, selected):
     '''push mapped branches to remote'''
+    selected = frozenset(selected)
     if not selected and not all_:
         raise click.ClickException('nothing selected to push')
 
-    for branch in ptt:
-        if selected and branch.name not in selected:
-            continue
-        LOG.warning('pushing commit %s -> %s:%s', ptt.format_id(branch.head), ptt.remote, branch.name)
-        res = ptt.remote.push(f'+{branch.head}:refs/heads/{branch.name}')
+    branches = [branch for branch in ptt
+                if not selected or branch.name in selected]
+
+    for res in _map_branches(_push_one, ptt, branches, jobs):
         if res:
             LOG.warning(res)
 
@@ -112,10 +205,14 @@ def check(ptt):
     '''verify that mapped branches match remote references'''
     LOG.info('updating remote %s', ptt.remote)
     ptt.remote.update()
+
+    # remote.refs is a list, so look up branches in a dictionary instead
+    remote_refs = {ref.remote_head: ref for ref in ptt.remote.refs}
+
     results = []
     for branch in ptt:
         local_ref = branch.head
-        remote_ref = ptt.remote.refs[branch.name].commit if branch.name in ptt.remote.refs else '-'
+        remote_ref = remote_refs[branch.name].commit if branch.name in remote_refs else '-'
 
         in_sync = local_ref == remote_ref
         results.append(
@@ -124,26 +221,27 @@ def check(ptt):
              in_sync)
         )
 
-    print(tabulate.tabulate(
+    _print_table(
         results,
-        headers=['remote', 'branch', 'local ref', 'remote ref', 'in sync']))
+        headers=['remote', 'branch', 'local ref', 'remote ref', 'in sync'])
 
 
 @remote.command()
 @click.option('--all/--no-all', '-a', 'all_')
+@click.option('--jobs', '-j', type=click.IntRange(min=1))
 @click.argument('selected', nargs=-1)
 @click.pass_obj
-def prune(ptt, all_, selected):
+def prune(ptt, all_, jobs, selected):
     '''delete mapped branches from remote repository'''
+    selected = frozenset(selected)
 
     if not selected and not all_:
         raise click.ClickException('nothing selected to prune')
 
-    for branch in ptt:
-        if selected and branch.name not in selected:
-            continue
-        LOG.warning('deleting branch %s:%s', ptt.remote, branch.name)
-        ptt.remote.push(f':refs/heads/{branch.name}', force_with_lease=True)
+    branches = [branch for branch in ptt
+                if not selected or branch.name in selected]
+
+    _map_branches(_delete_one, ptt, branches, jobs)
 
 
 @main.group()
@@ -169,11 +267,13 @@ def checkout(ptt, force, name):
     except TypeError:
         active_branch = None
 
-    if branch.name not in ptt.repo.heads:
+    heads = {head.name: head for head in ptt.repo.heads}
+
+    if branch.name not in heads:
         LOG.warning('creating git branch %s@%s', branch.name, branch.head)
         ref = ptt.create_git_branch(branch.name, branch.head, active_branch)
     else:
-        ref = ptt.repo.heads[branch.name]
+        ref = heads[branch.name]
 
         if ref.commit == branch.head or force:
             LOG.warning('checking out git branch %s@%s',
@@ -193,17 +293,21 @@ def checkout(ptt, force, name):
 @click.pass_obj
 def prune(ptt, all_, continue_, force, selected):
     '''remove git branches that correspond to mapped branches'''
+    selected = frozenset(selected)
 
-    if selected is None and not all_:
+    if not selected and not all_:
         raise click.ClickException('no branches to prune')
 
+    # repo.heads is a list, so look up branches in a dictionary instead
+    heads = {head.name: head for head in ptt.repo.heads}
+
     for branch in ptt:
         if selected and branch.name not in selected:
             continue
 
-        if branch.name in ptt.repo.heads:
+        if branch.name in heads:
             LOG.warning('deleting git branch %s', branch.name)
-            ref = ptt.repo.heads[branch.name]
+            ref = heads[branch.name]
 
             if ref.commit != branch.head and not force:
                 LOG.error('not deleting %s (out of sync)', branch.name)
@@ -242,7 +346,11 @@ def update(ptt, stack, prune, name):
 
         name = current_branch.name
 
-    branch = ptt.branches[name]
+    try:
+        branch = ptt.branches[name]
+    except KeyError as err:
+        raise click.ClickException(f'no such branch {err}')
+
     current_head = ptt.repo.head.commit
 
     LOG.warning('updating mapped branch %s in %s to %s',
@@ -261,7 +369,13 @@ def update(ptt, stack, prune, name):
 @click.pass_obj
 def shell(ptt):
     '''interactive shell with access to the PTT object'''
-    vars = locals()
+
+    # these are only needed here, so don't import them on every invocation
+    import code
+    import readline
+    import rlcompleter
+
+    vars = {'ptt': ptt}
     readline.set_completer(rlcompleter.Completer(vars).complete)
     readline.parse_and_bind('tab: complete')
     code.InteractiveConsole(vars).interact(banner='PTT API available as "ptt" object')
@@ -273,18 +387,18 @@ def stats(ptt):
     '''show summary diff statistics for each mapped branch'''
 
     table = []
+    branches = list(ptt)
 
-    for branch in ptt:
-        t_added = t_deleted = t_files = t_lines = 0
-        for commit in branch.commits:
-            t_added += commit.stats.total['insertions']
-            t_deleted += commit.stats.total['deletions']
-            t_lines += commit.stats.total['lines']
-            t_files += commit.stats.total['files']
-
-        table.append((
-            branch.name, t_added, t_deleted, t_lines, t_added-t_deleted, t_files,
-        ))
-
-    print(tabulate.tabulate(table,
-                            headers=['branch', 'added', 'deleted', 'lines', 'net', 'files']))
+    # each branch is summarized by a separate git process, so we can run
+    # them in parallel.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()) as executor:
+        results = executor.map(ptt.branch_stats, branches)
+
+        for branch, (t_added, t_deleted, t_files) in zip(branches, results):
+            table.append((
+                branch.name, t_added, t_deleted, t_added+t_deleted, t_added-t_deleted, t_files,
+            ))
+
+    _print_table(table,
+                 headers=['branch', 'added', 'deleted', 'lines', 'net', 'files'])
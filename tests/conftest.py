@@ -0,0 +1,26 @@
+import git
+import pytest
+
+
+@pytest.fixture
+def stack(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'home' / '.config'))
+    monkeypatch.delenv('GIT_NOTES_REF', raising=False)
+    for var in ['AUTHOR', 'COMMITTER']:
+        monkeypatch.setenv(f'GIT_{var}_NAME', 'Test')
+        monkeypatch.setenv(f'GIT_{var}_EMAIL', 'test@example.com')
+
+    repo = git.Repo.init(tmp_path / 'repo', initial_branch='master')
+    commit(repo, 'base')
+    repo.git.checkout('-b', 'stack')
+    commit(repo, 'first\n\n@one')
+    commit(repo, 'second')
+    commit(repo, 'third\n\n@two')
+    commit(repo, 'fourth')
+    return repo
+
+
+def commit(repo, message):
+    repo.git.commit('--allow-empty', '-m', message)
+    return repo.head.commit.hexsha
@@ -0,0 +1,178 @@
+import pytest
+import random
+
+from git_ptt.api import PTT
+
+from conftest import commit
+
+
+def test_branches(stack):
+    ptt = PTT(stack)
+    assert list(ptt.branches) == ['two', 'one']
+    assert ptt.branches['two'].hexsha == stack.commit('HEAD').hexsha
+    assert ptt.branches['two'].length == 2
+    assert ptt.branches['one'].hexsha == stack.commit('HEAD~2').hexsha
+    assert ptt.branches['one'].length == 2
+
+
+def test_branch_from_note(stack):
+    stack.git.notes('add', '-m', '@three', 'HEAD')
+
+    ptt = PTT(stack)
+    assert list(ptt.branches) == ['three', 'two', 'one']
+    assert ptt.branches['three'].length == 1
+
+
+def test_notes_ref_outside_refs(stack, monkeypatch):
+    monkeypatch.setenv('GIT_NOTES_REF', 'foo')
+
+    ptt = PTT(stack)
+    assert not ptt.has_notes
+    assert list(ptt.branches) == ['two', 'one']
+
+
+@pytest.fixture
+def walks(monkeypatch):
+    # counts the number of times PTT walks the stack rather than using the
+    # branch cache
+    calls = []
+    iter_stack = PTT.iter_stack
+
+    def counting_iter_stack(self):
+        calls.append(self)
+        return iter_stack(self)
+
+    monkeypatch.setattr(PTT, 'iter_stack', counting_iter_stack)
+    return calls
+
+
+def branch_map(ptt):
+    return {name: (branch.hexsha, branch.length)
+            for name, branch in ptt.branches.items()}
+
+
+def test_cache_reused(stack, walks):
+    expected = branch_map(PTT(stack))
+    assert branch_map(PTT(stack)) == expected
+    assert len(walks) == 1
+
+
+def test_cache_head_changed(stack, walks):
+    PTT(stack)
+    commit(stack, 'fifth\n\n@three')
+
+    ptt = PTT(stack)
+    assert len(walks) == 2
+    assert list(ptt.branches) == ['three', 'two', 'one']
+
+
+def test_cache_base_changed(stack, walks):
+    PTT(stack)
+
+    ptt = PTT(stack, base='HEAD~2')
+    assert len(walks) == 2
+    assert list(ptt.branches) == ['two']
+
+
+def test_cache_marker_changed(stack, walks):
+    PTT(stack)
+
+    ptt = PTT(stack, marker='%')
+    assert len(walks) == 2
+    assert list(ptt.branches) == []
+
+
+def test_cache_notes_changed(stack, walks):
+    PTT(stack)
+
+    stack.git.notes('add', '-m', '@three', 'HEAD')
+    assert list(PTT(stack).branches) == ['three', 'two', 'one']
+
+    stack.git.notes('add', '-m', '@four', 'HEAD~2')
+    assert list(PTT(stack).branches) == ['three', 'two', 'four', 'one']
+    assert len(walks) == 3
+
+
+@pytest.mark.parametrize('content', ['', '{"key": [', 'garbage', '[]',
+                                     '{"key": null}'])
+def test_cache_corrupt(stack, walks, content):
+    expected = branch_map(PTT(stack))
+
+    ptt = PTT(stack)
+    with open(ptt.cache_path, 'w') as fd:
+        fd.write(content)
+
+    assert branch_map(PTT(stack)) == expected
+    assert len(walks) == 2
+
+
+def test_cache_truncated(stack, walks):
+    ptt = PTT(stack)
+    expected = branch_map(ptt)
+
+    with open(ptt.cache_path, 'r+') as fd:
+        fd.truncate(len(fd.read()) // 2)
+
+    assert branch_map(PTT(stack)) == expected
+    assert len(walks) == 2
+
+
+def test_cached_branch_matches_walk(stack, walks):
+    fresh = PTT(stack)
+    cached = PTT(stack)
+    assert len(walks) == 1
+
+    for name, branch in fresh.branches.items():
+        assert cached.branches[name].hexsha == branch.hexsha
+        assert cached.branches[name].length == branch.length
+        assert ([c.hexsha for c in cached.branches[name].commits]
+                == [c.hexsha for c in branch.commits])
+
+
+MARKER_MESSAGES = [
+    '',
+    '{m}',
+    '{m}one',
+    'subject\n\n{m}one',
+    '\n{m}one',
+    'subject\n\n  {m}one',
+    'subject\n\n{m}one \n',
+    'subject\n\n{m}one\r\n',
+    'subject\r\n\r\n{m}one\r\n',
+    'subject\n\n{m}one two\n{m}three',
+    'subject\n\n{m} one',
+    'subject {m}one',
+    'subject\n\n{m}one\x1ctwo',
+    'subject\n\n{m}one\x85',
+    'subject\x85{m}one',
+    'subject\x1c{m}one',
+    'subject\n\n\t{m}{m}one\n',
+    'subject\n\n{m}\n{m}two',
+    '{m}one two\n{m}three',
+    '{m}ONE\n',
+]
+
+
+@pytest.mark.parametrize('marker', ['@', '@@', '#', '+', '.', 'PR:'])
+def test_match_marker(stack, marker):
+    # match_marker takes shortcuts for most markers, but it must always
+    # find the same branch as the marker regex
+    ptt = PTT(stack, marker=marker)
+
+    def expected(content):
+        match = ptt._marker_re.search(content)
+        return match.group('branch') if match else None
+
+    messages = [message.format(m=marker) for message in MARKER_MESSAGES]
+    messages += [message.format(m=marker.lower())
+                 for message in MARKER_MESSAGES]
+
+    rand = random.Random(marker)
+    alphabet = [marker, marker[0], ' ', '\t', '\n', '\r', '\x0b', '\x0c',
+                '\x1c', '\x1d', '\x1e', '\x85', '\u2028', '\xa0',
+                'a', 'B', '-', '/']
+    for i in range(2000):
+        messages.append(''.join(rand.choices(alphabet, k=rand.randint(0, 12))))
+
+    for message in messages:
+        assert ptt.match_marker(message) == expected(message), repr(message)
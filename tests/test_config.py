@@ -0,0 +1,103 @@
+import git
+import os
+import pytest
+
+from git_ptt.api import _read_config
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    home.mkdir()
+    monkeypatch.setenv('HOME', str(home))
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(home / '.config'))
+    return home
+
+
+@pytest.fixture
+def repo(tmp_path, home):
+    return git.Repo.init(tmp_path / 'repo')
+
+
+def write_config(repo, content):
+    with open(os.path.join(repo.git_dir, 'config'), 'a') as fd:
+        fd.write(content)
+
+
+def test_simple_values(repo):
+    write_config(repo, '[PTT]\n\tMarker = %\n\tbase = main\n')
+
+    sections = _read_config(repo)
+    assert sections[('ptt', None)] == {'marker': '%', 'base': 'main'}
+
+
+def test_quoted_value(repo):
+    write_config(repo, '[ptt]\n\tmarker = "% "\n')
+
+    sections = _read_config(repo)
+    assert sections[('ptt', None)]['marker'] == '% '
+
+
+def test_bare_boolean_key(repo):
+    write_config(repo, '[ptt]\n\tcommitGraph\n')
+
+    sections = _read_config(repo)
+    assert sections[('ptt', None)]['commitgraph'] == 'true'
+
+
+@pytest.mark.parametrize('extra', ['', '[ptt]\n\tquoted = "yes"\n'])
+def test_subsection_case(repo, extra):
+    # the second case forces the GitConfigParser fallback
+    write_config(repo, '[PTT "Feature"]\n\tmarker = %\n' + extra)
+
+    sections = _read_config(repo)
+    assert sections[('ptt', 'Feature')] == {'marker': '%'}
+    assert ('ptt', 'feature') not in sections
+
+
+def test_escaped_subsection(repo):
+    write_config(repo, '[branch "we\\"ird"]\n\tremote = origin\n')
+
+    sections = _read_config(repo)
+    assert sections[('branch', 'we"ird')] == {'remote': 'origin'}
+
+
+def test_include(repo, home):
+    (home / 'ptt.inc').write_text('[ptt]\n\tmarker = %\n')
+    (home / '.gitconfig').write_text(
+        f'[include]\n\tpath = {home / "ptt.inc"}\n')
+
+    sections = _read_config(repo)
+    assert sections[('ptt', None)]['marker'] == '%'
+
+
+def test_include_if(repo, home):
+    (home / 'ptt.inc').write_text('[ptt]\n\tmarker = %\n')
+    (home / '.gitconfig').write_text(
+        f'[includeIf "gitdir:{repo.working_dir}/"]\n'
+        f'\tpath = {home / "ptt.inc"}\n'
+        '[includeIf "gitdir:/nonexistent/"]\n'
+        '\tpath = /nonexistent/ptt.inc\n')
+
+    sections = _read_config(repo)
+    assert sections[('ptt', None)]['marker'] == '%'
+
+
+def test_changed_file(repo):
+    write_config(repo, '[ptt]\n\tmarker = %\n')
+    assert _read_config(repo)[('ptt', None)]['marker'] == '%'
+
+    path = os.path.join(repo.git_dir, 'config')
+    mtime = os.stat(path).st_mtime_ns
+    write_config(repo, '[ptt]\n\tmarker = !\n')
+    os.utime(path, ns=(mtime + 1_000_000_000, mtime + 1_000_000_000))
+
+    assert _read_config(repo)[('ptt', None)]['marker'] == '!'
+
+
+def test_unreadable_file(repo, home):
+    (home / '.gitconfig').mkdir()
+    write_config(repo, '[ptt]\n\tmarker = %\n')
+
+    sections = _read_config(repo)
+    assert sections[('ptt', None)]['marker'] == '%'
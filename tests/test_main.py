@@ -0,0 +1,56 @@
+import click
+import git
+import pytest
+
+from git_ptt.api import PTT
+from git_ptt.main import _delete_one, _map_branches, _print_table, _push_one
+
+
+def test_print_table(capsys):
+    _print_table([('one', 10, True), ('three', 2, False)],
+                 headers=['branch', 'lines', 'ok'])
+    assert capsys.readouterr().out.splitlines() == [
+        'branch      lines  ok',
+        '--------  -------  -----',
+        'one            10  True',
+        'three           2  False',
+    ]
+
+
+def test_print_table_empty(capsys):
+    _print_table([], headers=['branch', 'lines'])
+    assert capsys.readouterr().out.splitlines() == [
+        'branch    lines',
+        '--------  -------',
+    ]
+
+
+@pytest.fixture
+def ptt(stack, tmp_path):
+    git.Repo.init(tmp_path / 'remote.git', bare=True)
+    stack.create_remote('origin', str(tmp_path / 'remote.git'))
+    return PTT(stack, remote='origin')
+
+
+def test_map_branches(ptt):
+    branches = list(ptt)
+    _map_branches(_push_one, ptt, branches)
+
+    remote = git.Repo(ptt.remote.url)
+    assert {head.name: head.commit.hexsha for head in remote.heads} == {
+        branch.name: branch.hexsha for branch in branches}
+
+
+def test_map_branches_stale_lease(ptt, caplog):
+    _map_branches(_push_one, ptt, list(ptt))
+
+    # move the remote branch without updating our remote-tracking ref, so
+    # that deleting it with --force-with-lease is rejected
+    remote = git.Repo(ptt.remote.url)
+    remote.git.update_ref('refs/heads/one', ptt.branches['two'].hexsha)
+
+    with pytest.raises(click.ClickException, match='failed to update one'):
+        _map_branches(_delete_one, ptt, [ptt.branches['one']])
+
+    assert 'stale info' in caplog.text
+    assert remote.heads.one.commit.hexsha == ptt.branches['two'].hexsha